@@ -1,26 +1,59 @@
 from flask import Flask, request, jsonify, render_template_string
 from flask_cors import CORS
+import numpy as np
 import subprocess
 import os
 import tempfile
 import shutil
 import time
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import defaultdict, OrderedDict
+import threading
+import multiprocessing
+from contextlib import contextmanager
 import json
+import logging
 from pathlib import Path
 import re
 
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只能使用进程内的锁
+    fcntl = None
+
 app = Flask(__name__)
 CORS(app)
 
-# 移除缓存机制，每次都重新统计
+# 逐文件的调试日志默认关闭，%格式化参数只在启用DEBUG级别时才会求值
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# 统计结果按仓库最新提交的SHA缓存到磁盘，仓库有新提交时自动重新统计
 
 # 配置
 TEMP_DIR = tempfile.gettempdir()
 REPOS_DIR = os.path.join(TEMP_DIR, 'github_stats_repos')
+STATS_CACHE_DIR = os.path.join(TEMP_DIR, 'github_stats_cache')
+# 统计结果缓存的有效期（秒）
+STATS_CACHE_TTL = 24 * 60 * 60
+# 仓库超过该时间（秒）未使用时删除本地副本
+REPO_MAX_AGE = 24 * 60 * 60
+# 设置环境变量 GITHUB_STATS_USE_TOKEI=1 且已安装tokei时，改用tokei统计代码行数
+# tokei按语言识别文件，不识别的文件类型不会计入统计
+TOKEI_PATH = shutil.which('tokei') if os.environ.get('GITHUB_STATS_USE_TOKEI') == '1' else None
+# 分析文件时的并行进程数，超过8个后磁盘I/O成为瓶颈，收益不明显
+ANALYZE_WORKERS = min(8, os.cpu_count() or 1)
+# 文本检测的样本大小和统计行数时的分块读取大小
+SAMPLE_SIZE = 64 * 1024
+READ_BLOCK_SIZE = 1024 * 1024
+# 文件检测结果缓存的最大条目数
+CLASSIFY_CACHE_SIZE = 200000
+# 进程内统计结果缓存的最大条目数
+STATS_MEMORY_CACHE_SIZE = 32
 
 # 二进制文件扩展名和魔数标识
-BINARY_EXTENSIONS = {
+BINARY_EXTENSIONS = frozenset({
     '.exe', '.dll', '.so', '.dylib', '.a', '.lib', '.obj', '.o',
     '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.ico', '.webp',
     '.mp3', '.wav', '.flac', '.aac', '.ogg', '.mp4', '.avi', '.mkv', '.mov',
@@ -29,10 +62,28 @@ BINARY_EXTENSIONS = {
     '.bin', '.dat', '.db', '.sqlite', '.sqlite3',
     '.ttf', '.otf', '.woff', '.woff2', '.eot',
     '.pyc', '.pyo', '.class', '.jar', '.war'
-}
+})
+
+# 常见的文本文件扩展名，命中时跳过内容检测直接统计行数
+TEXT_EXTENSIONS = frozenset({
+    '.py', '.js', '.ts', '.c', '.h', '.cpp', '.rs', '.go', '.java',
+    '.md', '.txt', '.json', '.yaml', '.yml', '.html', '.css',
+    '.sh', '.rb', '.php', '.xml', '.toml', '.ini', '.cfg'
+})
 
-# 常见的二进制文件魔数
-BINARY_SIGNATURES = [
+# 遍历时跳过的非代码目录（依赖、构建产物、虚拟环境等）
+SKIP_DIRS = frozenset({
+    'node_modules', '__pycache__', 'build', 'dist', 'target',
+    '.git', 'vendor', '.venv', 'venv', '.tox'
+})
+
+# 不可打印控制字符查找表（0-31中除Tab、LF、CR以外的字节），供NumPy按字节值索引
+CONTROL_BYTES = np.zeros(256, dtype=bool)
+CONTROL_BYTES[:32] = True
+CONTROL_BYTES[[0x09, 0x0A, 0x0D]] = False
+
+# 常见的二进制文件魔数，使用元组以便bytes.startswith一次匹配全部
+BINARY_SIGNATURES = (
     b'\x89PNG',  # PNG
     b'\xff\xd8\xff',  # JPEG
     b'GIF8',  # GIF
@@ -44,24 +95,233 @@ BINARY_SIGNATURES = [
     b'MZ',  # Windows executable
     b'\xca\xfe\xba\xbe',  # Java class
     b'%PDF',  # PDF
-]
+)
+
+# 文件检测结果缓存：(路径, st_dev, st_ino, st_size, st_mtime_ns) -> (是否为文本文件, 行数)
+# 同一工作区重复分析时，内容未变化的文件无需再次读取
+classify_cache = OrderedDict()
+classify_cache_lock = threading.Lock()
+
+# 对同一个仓库目录的更新和分析需要串行执行：进程内使用线程锁，
+# 多个gunicorn worker之间使用 <repo_dir>.lock 文件上的 flock
+repo_locks = defaultdict(threading.Lock)
+repo_locks_lock = threading.Lock()
+
+# 进程内的统计结果缓存：(owner, repo, commit_sha) -> (写入时间, 统计结果)
+# 命中时省去读取和解析磁盘缓存文件；读取不加锁，写入时整体替换字典
+stats_memory_cache = {}
+stats_memory_cache_lock = threading.Lock()
+
+# 进程内常驻的分析进程池，首次使用时创建，避免每次分析都重新启动子进程
+# 子进程在持有 repo_lock 时才会启动，直接fork会继承锁文件描述符，
+# 导致 flock 在请求结束后仍不释放，因此优先使用 forkserver 启动子进程
+analyze_executor = None
+analyze_executor_lock = threading.Lock()
 
 def ensure_repos_dir():
     """确保仓库目录存在"""
     if not os.path.exists(REPOS_DIR):
         os.makedirs(REPOS_DIR)
 
-def clean_all_repos():
-    """清理所有旧仓库，确保每次都是全新的clone"""
+def clean_old_repos():
+    """清理长时间未使用的仓库，最近使用过的仓库保留以便增量更新"""
     if not os.path.exists(REPOS_DIR):
         return
     
+    now = time.time()
+    for entry in os.scandir(REPOS_DIR):
+        try:
+            if now - entry.stat(follow_symlinks=False).st_mtime <= REPO_MAX_AGE:
+                continue
+            
+            if entry.is_dir(follow_symlinks=False):
+                repo_dir = entry.path
+            elif entry.name.endswith('.lock') and not os.path.exists(entry.path[:-len('.lock')]):
+                # 克隆失败时仓库目录已被删除，只剩下锁文件
+                repo_dir = entry.path[:-len('.lock')]
+            else:
+                continue
+            
+            # 仓库正被其他请求使用时跳过，不删除别人正在分析的目录
+            lock_file = _open_repo_lock(repo_dir, blocking=False)
+            if lock_file is None:
+                continue
+            
+            with lock_file:
+                if os.path.isdir(repo_dir):
+                    shutil.rmtree(repo_dir)
+                # 持有锁时删除锁文件，正在等待的请求加锁后会发现锁文件已被删除并重新打开
+                if fcntl is not None:
+                    os.remove(f"{repo_dir}.lock")
+            if fcntl is None:
+                os.remove(f"{repo_dir}.lock")
+            print(f"Cleaned old repo: {entry.name}")
+        except Exception as e:
+            print(f"Failed to clean repo {entry.name}: {e}")
+
+def _watch_owner(owner_pid):
+    """分析子进程的初始化函数：创建进程池的worker退出后子进程随之退出"""
+    def watch():
+        while True:
+            time.sleep(5)
+            try:
+                os.kill(owner_pid, 0)
+            except ProcessLookupError:
+                os._exit(0)
+    
+    threading.Thread(target=watch, daemon=True).start()
+
+def get_analyze_executor():
+    """获取常驻的分析进程池，不存在时创建"""
+    global analyze_executor
+    with analyze_executor_lock:
+        if analyze_executor is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                # gunicorn worker 被强制结束时子进程不会收到通知，需自行检测后退出
+                analyze_executor = ProcessPoolExecutor(
+                    max_workers=ANALYZE_WORKERS,
+                    mp_context=multiprocessing.get_context('forkserver'),
+                    initializer=_watch_owner,
+                    initargs=(os.getpid(),)
+                )
+            else:
+                analyze_executor = ProcessPoolExecutor(max_workers=ANALYZE_WORKERS)
+        return analyze_executor
+
+def reset_analyze_executor():
+    """丢弃已损坏的进程池，下次使用时重新创建"""
+    global analyze_executor
+    with analyze_executor_lock:
+        if analyze_executor is not None:
+            analyze_executor.shutdown(wait=False)
+            analyze_executor = None
+
+def get_remote_head(repo_url):
+    """获取远程仓库默认分支最新提交的SHA，失败时返回None"""
+    try:
+        cmd = ['git', 'ls-remote', repo_url, 'HEAD']
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        if result.returncode == 0 and result.stdout.strip():
+            return result.stdout.split()[0]
+        print(f"Git ls-remote failed: {result.stderr.strip()}")
+    except Exception as e:
+        print(f"Git ls-remote exception: {e}")
+    return None
+
+def get_local_head(repo_dir):
+    """获取本地仓库副本当前检出提交的SHA，空仓库或失败时返回None"""
     try:
-        # 删除整个仓库目录
-        shutil.rmtree(REPOS_DIR)
-        print("Cleaned all old repos")
+        cmd = ['git', '-C', repo_dir, 'rev-parse', '--verify', '-q', 'HEAD']
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        if result.returncode == 0 and result.stdout.strip():
+            return result.stdout.strip()
     except Exception as e:
-        print(f"Failed to clean repos directory: {e}")
+        print(f"Git rev-parse exception: {e}")
+    return None
+
+def _safe_name(*parts):
+    """用下划线连接各部分作为文件名，特殊字符替换为下划线"""
+    return re.sub(r'[^A-Za-z0-9._-]', '_', '_'.join(parts))
+
+def _stats_cache_path(owner, repo, commit_sha):
+    """统计结果缓存文件路径"""
+    return os.path.join(STATS_CACHE_DIR, f"{_safe_name(owner, repo, commit_sha)}.json")
+
+def _get_repo_lock(repo_dir):
+    """获取仓库目录对应的进程内锁"""
+    with repo_locks_lock:
+        return repo_locks[repo_dir]
+
+def _try_flock(lock_file, blocking=True):
+    """对锁文件加排他锁，非阻塞模式下锁已被占用时返回False"""
+    if fcntl is None:
+        return True
+    flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+    try:
+        fcntl.flock(lock_file.fileno(), flags)
+        return True
+    except BlockingIOError:
+        return False
+
+def _open_repo_lock(repo_dir, blocking=True):
+    """打开并锁定仓库的锁文件，返回加锁后的文件对象，非阻塞模式下锁已被占用时返回None"""
+    lock_path = f"{repo_dir}.lock"
+    while True:
+        lock_file = open(lock_path, 'a')
+        if not _try_flock(lock_file, blocking):
+            lock_file.close()
+            return None
+        
+        # 等待期间锁文件可能已被 clean_old_repos 删除，锁住的是旧文件时需重新打开
+        try:
+            if fcntl is None or os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+@contextmanager
+def repo_lock(repo_dir):
+    """跨进程锁定仓库目录，在整个更新和分析过程中持有"""
+    with _get_repo_lock(repo_dir):
+        with _open_repo_lock(repo_dir):
+            yield
+
+def _remember_stats(key, stored_at, stats):
+    """
+    写入进程内的统计结果缓存
+    复制出新字典修改后整体替换，读取方无需加锁也总能看到完整的字典
+    """
+    global stats_memory_cache
+    with stats_memory_cache_lock:
+        now = time.time()
+        cache = {k: v for k, v in stats_memory_cache.items()
+                 if now - v[0] <= STATS_CACHE_TTL}
+        cache[key] = (stored_at, stats)
+        while len(cache) > STATS_MEMORY_CACHE_SIZE:
+            del cache[next(iter(cache))]  # 淘汰最早写入的条目
+        stats_memory_cache = cache
+
+def load_cached_stats(owner, repo, commit_sha):
+    """读取缓存的统计结果，先查进程内缓存再查磁盘，不存在或已过期时返回None"""
+    key = (owner, repo, commit_sha)
+    entry = stats_memory_cache.get(key)
+    if entry is not None and time.time() - entry[0] <= STATS_CACHE_TTL:
+        return entry[1]
+    
+    cache_path = _stats_cache_path(owner, repo, commit_sha)
+    try:
+        stored_at = os.path.getmtime(cache_path)
+        if time.time() - stored_at > STATS_CACHE_TTL:
+            return None
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    _remember_stats(key, stored_at, stats)
+    return stats
+
+def save_cached_stats(owner, repo, commit_sha, stats):
+    """将统计结果写入进程内缓存和磁盘缓存，并清理已过期的缓存文件"""
+    _remember_stats((owner, repo, commit_sha), time.time(), stats)
+    
+    try:
+        os.makedirs(STATS_CACHE_DIR, exist_ok=True)
+        
+        # 先写临时文件再原子替换，避免其他进程读到写了一半的文件
+        cache_path = _stats_cache_path(owner, repo, commit_sha)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(stats, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, cache_path)
+        
+        now = time.time()
+        for entry in os.scandir(STATS_CACHE_DIR):
+            if entry.is_file() and now - entry.stat().st_mtime > STATS_CACHE_TTL:
+                os.remove(entry.path)
+    except OSError as e:
+        print(f"Failed to write stats cache: {e}")
 
 def clone_repository(repo_url, target_dir):
     """克隆仓库到指定目录"""
@@ -73,8 +333,12 @@ def clone_repository(repo_url, target_dir):
         # 创建父目录
         os.makedirs(os.path.dirname(target_dir), exist_ok=True)
         
-        # 使用浅克隆减少下载时间
-        cmd = ['git', 'clone', '--depth', '1', repo_url, target_dir]
+        # 使用浅克隆 + 部分克隆减少下载量：只拉取默认分支的最新提交，
+        # 不下载标签，blob对象延迟到检出时一次性批量获取
+        cmd = ['git', '-c', 'protocol.version=2', 'clone',
+               '--depth', '1', '--single-branch', '--no-tags',
+               '--filter=blob:none', '--no-checkout',
+               repo_url, target_dir]
         print(f"Executing: {' '.join(cmd)}")
         result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
         
@@ -82,196 +346,260 @@ def clone_repository(repo_url, target_dir):
         print(f"Git clone stdout: {result.stdout}")
         print(f"Git clone stderr: {result.stderr}")
         
+        if result.returncode != 0:
+            return False, f"克隆失败: {result.stderr.strip()}"
+        
+        # 空仓库没有任何提交，无需检出
+        cmd = ['git', '-C', target_dir, 'rev-parse', '--verify', '-q', 'HEAD']
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        if result.returncode != 0:
+            print("Repository is empty, nothing to check out")
+            return True, "克隆成功"
+        
+        # 检出工作区文件，不使用路径参数，提交中没有任何文件时也能成功
+        cmd = ['git', '-C', target_dir, 'reset', '--hard', 'HEAD']
+        print(f"Executing: {' '.join(cmd)}")
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        
+        print(f"Git checkout return code: {result.returncode}")
+        print(f"Git checkout stderr: {result.stderr}")
+        
         if result.returncode == 0:
             return True, "克隆成功"
         else:
-            return False, f"克隆失败: {result.stderr.strip()}"
+            # 删除检出失败的目录，避免下次请求把不完整的副本当作已有仓库增量更新
+            shutil.rmtree(target_dir, ignore_errors=True)
+            return False, f"检出失败: {result.stderr.strip()}"
     except subprocess.TimeoutExpired:
+        shutil.rmtree(target_dir, ignore_errors=True)
         return False, "克隆超时"
     except Exception as e:
         return False, f"克隆异常: {str(e)}"
 
-def is_text_file(file_path):
+def _is_text_sample(chunk):
     """
-    使用多种方法智能判断文件是否为文本文件
-    包括扩展名、魔数、字符编码等检测方法
+    根据文件开头的样本判断是否为文本文件
+    包括魔数、NULL字节和控制字符比例等检测方法
+    """
+    # 1. 检查二进制文件魔数标识
+    if chunk.startswith(BINARY_SIGNATURES):
+        return False
+    
+    # 2. 使用NumPy向量化统计字节分布，避免逐字节的Python循环
+    arr = np.frombuffer(chunk, dtype=np.uint8)
+    null_count = int(np.count_nonzero(arr == 0))
+    ctrl_count = int(np.count_nonzero(CONTROL_BYTES[arr]))
+    
+    # 检查NULL字节（二进制文件的明显特征），允许少量NULL字节
+    if null_count / arr.size > 0.01:  # 超过1%的NULL字节就认为是二进制
+        return False
+    
+    # 3. 检查不可打印控制字符（除了Tab、LF、CR）
+    if ctrl_count / arr.size > 0.02:  # 超过2%控制字符
+        return False
+    
+    # 通过上述检查即认为是文本文件，统计行数不需要解码，因此不再逐个尝试编码
+    return True
+
+def update_repository(repo_url, target_dir):
+    """
+    更新已有的仓库副本到远程最新提交，只增量拉取变化的对象
+    本地副本不存在或更新失败时重新克隆；git锁文件冲突时直接返回失败，不删除目录
+    """
+    if os.path.isdir(os.path.join(target_dir, '.git')):
+        commands = [
+            ['git', '-C', target_dir, 'remote', 'set-url', 'origin', repo_url],
+            ['git', '-C', target_dir, '-c', 'protocol.version=2', 'fetch',
+             '--depth', '1', '--no-tags', 'origin', 'HEAD'],
+            ['git', '-C', target_dir, 'reset', '--hard', 'FETCH_HEAD'],
+        ]
+        try:
+            for cmd in commands:
+                print(f"Executing: {' '.join(cmd)}")
+                result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+                if result.returncode != 0:
+                    print(f"Git update failed: {result.stderr.strip()}")
+                    # 其他git进程正在操作该仓库（如残留的 index.lock），不能删除目录重新克隆
+                    if '.lock' in result.stderr:
+                        return False, "仓库正在被其他进程更新，请稍后重试"
+                    break
+            else:
+                return True, "更新成功"
+        except subprocess.TimeoutExpired:
+            print("Git update timed out")
+        except Exception as e:
+            print(f"Git update exception: {e}")
+    
+    # 增量更新失败时回退为全新克隆
+    return clone_repository(repo_url, target_dir)
+
+def classify_and_count(file_path, file_size, ext):
+    """
+    判断文件是否为文本文件并统计行数，整个过程只打开、读取文件一次
+    常见源码扩展名直接视为文本文件，其余文件先检测开头的样本，
+    确认是文本文件后再继续分块读取剩余内容统计换行符
+    file_size 由调用方从目录遍历时的stat结果传入，避免重复stat
+    ext 为调用方预先计算好的小写扩展名
+    返回 (是否为文本文件, 行数)
     """
     try:
-        print(f"[DEBUG] Checking file: {file_path}")
+        logger.debug("Checking file: %s", file_path)
         # 快速检查：文件大小限制
-        file_size = os.path.getsize(file_path)
         if file_size == 0:  # 空文件
-            print(f"[DEBUG] {file_path}: Skipped - empty file")
-            return False
+            logger.debug("%s: Skipped - empty file", file_path)
+            return False, 0
         if file_size > 10 * 1024 * 1024:  # 超过10MB跳过
-            print(f"[DEBUG] {file_path}: Skipped - too large ({file_size} bytes)")
-            return False
+            logger.debug("%s: Skipped - too large (%d bytes)", file_path, file_size)
+            return False, 0
             
         # 快速检查：扩展名黑名单
-        _, ext = os.path.splitext(file_path)
-        if ext.lower() in BINARY_EXTENSIONS:
-            print(f"[DEBUG] {file_path}: Skipped - binary extension ({ext})")
-            return False
-        
-        # 读取文件内容进行深度检测
-        sample_size = min(8192, file_size)  # 读取8KB或整个文件
-        with open(file_path, 'rb') as f:
-            chunk = f.read(sample_size)
-            
-            # 1. 检查二进制文件魔数标识
-            for signature in BINARY_SIGNATURES:
-                if chunk.startswith(signature):
-                    return False
-            
-            # 2. 检查NULL字节（二进制文件的明显特征）
-            null_count = chunk.count(b'\x00')
-            if null_count > 0:
-                # 允许少量NULL字节（有些文本文件可能包含）
-                null_ratio = null_count / len(chunk)
-                if null_ratio > 0.01:  # 超过1%的NULL字节就认为是二进制
-                    return False
-            
-            # 3. 检查不可打印控制字符（除了常见的换行符等）
-            control_chars = 0
-            printable_controls = {0x09, 0x0A, 0x0D}  # Tab, LF, CR
-            for byte in chunk:
-                if byte < 32 and byte not in printable_controls:
-                    control_chars += 1
+        if ext in BINARY_EXTENSIONS:
+            logger.debug("%s: Skipped - binary extension (%s)", file_path, ext)
+            return False, 0
+        
+        # 快速检查：扩展名白名单，已知的文本文件跳过内容检测
+        known_text = ext in TEXT_EXTENSIONS
+        
+        with open(file_path, 'rb', buffering=READ_BLOCK_SIZE) as f:
+            chunk = f.read(SAMPLE_SIZE)
             
-            if len(chunk) > 0 and control_chars / len(chunk) > 0.02:  # 超过2%控制字符
-                return False
+            # 读取文件开头的样本进行深度检测
+            if not known_text:
+                result = _is_text_sample(chunk)
+                logger.debug("%s: Final result = %s", file_path, result)
+                if not result:
+                    return False, 0
             
-            # 4. 尝试使用常见编码解码文件
-            text_encodings = ['utf-8', 'gbk', 'gb2312', 'latin-1', 'cp1252']
-            decoded_successfully = False
+            # 确认是文本文件，继续分块读取统计换行符，行数与编码无关
+            lines = chunk.count(b'\n')
+            last_byte = chunk[-1:]
             
-            for encoding in text_encodings:
-                try:
-                    decoded_text = chunk.decode(encoding)
-                    
-                    # 检查解码后的文本质量
-                    if _is_reasonable_text(decoded_text):
-                        decoded_successfully = True
+            # 大文件的剩余部分读入同一个可复用的缓冲区，用NumPy向量化统计换行符
+            if file_size > len(chunk):
+                buffer = bytearray(READ_BLOCK_SIZE)
+                view = memoryview(buffer)
+                while True:
+                    size = f.readinto(buffer)
+                    if not size:
                         break
-                        
-                except (UnicodeDecodeError, UnicodeError):
-                    continue
+                    lines += int(np.count_nonzero(np.frombuffer(view[:size], dtype=np.uint8) == 0x0A))
+                    last_byte = buffer[size - 1:size]
             
-            result = decoded_successfully
-            print(f"[DEBUG] {file_path}: Final result = {result}")
-            return result
+            # 最后一行没有换行符时也算作一行
+            if last_byte != b'\n':
+                lines += 1
+            
+            return True, lines
             
     except Exception as e:
-        print(f"[DEBUG] {file_path}: Exception occurred - {e}")
-        return False
+        logger.debug("%s: Exception occurred - %s", file_path, e)
+        return False, 0
 
-def _is_reasonable_text(text):
+def iter_files(root):
     """
-    检查解码后的文本是否合理
+    使用os.scandir遍历目录，跳过隐藏文件和非代码目录
+    返回 (文件的DirEntry, 以/分隔的相对路径)
+    使用显式栈代替递归，每个目录只打开一次，读完后立即关闭
+    与os.walk一样，无法读取的目录和文件（如遍历期间被删除）直接跳过
     """
-    if not text:
-        return False
-    
-    # 检查文本中可打印字符的比例
-    printable_chars = 0
-    for char in text:
-        # 字母、数字、标点、空格、换行符等
-        if char.isprintable() or char in '\t\n\r\f\v':
-            printable_chars += 1
-    
-    printable_ratio = printable_chars / len(text)
-    
-    # 要求至少85%的字符是可打印的
-    return printable_ratio >= 0.85
-
-def count_lines_in_file(file_path):
-    """统计单个文件的行数"""
-    try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            return len(f.readlines())
-    except:
+    stack = [(root, '')]
+    while stack:
+        dir_path, prefix = stack.pop()
+        subdirs = []
         try:
-            with open(file_path, 'r', encoding='gbk', errors='ignore') as f:
-                return len(f.readlines())
-        except:
-            try:
-                with open(file_path, 'r', encoding='latin-1', errors='ignore') as f:
-                    return len(f.readlines())
-            except:
-                return 0
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    # 跳过隐藏文件和目录（包括 .git）
+                    if entry.name.startswith('.'):
+                        continue
+                    
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        is_file = not is_dir and entry.is_file()
+                    except OSError:
+                        continue
+                    
+                    if is_dir:
+                        # 跳过常见的非代码目录
+                        if entry.name not in SKIP_DIRS:
+                            subdirs.append((entry.path, prefix + entry.name + '/'))
+                    elif is_file:
+                        yield entry, prefix + entry.name
+        except OSError as e:
+            print(f"Failed to scan directory {dir_path}: {e}")
+        
+        # 逆序入栈，保持与目录列出顺序一致的深度优先遍历
+        stack.extend(reversed(subdirs))
 
-def analyze_repository(repo_path):
-    """分析仓库结构和代码行数"""
-    stats = {
+def _get_cached_classification(key):
+    """从文件检测缓存中读取结果，未命中返回None"""
+    with classify_cache_lock:
+        result = classify_cache.get(key)
+        if result is not None:
+            classify_cache.move_to_end(key)
+        return result
+
+def _put_cached_classification(key, result):
+    """写入文件检测缓存，超出容量时淘汰最久未使用的条目"""
+    with classify_cache_lock:
+        classify_cache[key] = result
+        classify_cache.move_to_end(key)
+        while len(classify_cache) > CLASSIFY_CACHE_SIZE:
+            classify_cache.popitem(last=False)
+
+def _new_stats():
+    """创建空的统计结果"""
+    return {
         'total_lines': 0,
         'total_files': 0,
         'file_stats': {},
         'folder_stats': {},
         'file_type_stats': defaultdict(int)
     }
+
+def _add_file_stats(stats, relative_path, lines, size, ext):
+    """将单个文件的统计累加到总数、文件类型和所有父级文件夹"""
+    stats['total_lines'] += lines
+    stats['total_files'] += 1
     
-    for root, dirs, files in os.walk(repo_path):
-        # 跳过 .git 目录
-        if '.git' in dirs:
-            dirs.remove('.git')
-        
-        # 跳过常见的非代码目录
-        dirs[:] = [d for d in dirs if not d.startswith('.') and 
-                  d not in ['node_modules', '__pycache__', 'build', 'dist', 'target']]
-        
-        for file in files:
-            file_path = os.path.join(root, file)
-            relative_path = os.path.relpath(file_path, repo_path).replace('\\', '/')
-            
-            # 跳过隐藏文件，但保留重要文件
-            if file.startswith('.'):
-                continue
-            
-            # 只统计文本文件
-            if is_text_file(file_path):
-                lines = count_lines_in_file(file_path)
-                if lines > 0:  # 只统计非空文件
-                    stats['total_lines'] += lines
-                    stats['total_files'] += 1
-                    
-                    # 获取文件扩展名用于分类显示
-                    _, ext = os.path.splitext(file)
-                    file_type = ext if ext else '无扩展名'
-                    
-                    # 记录文件统计
-                    stats['file_stats'][relative_path] = {
-                        'lines': lines,
-                        'file_type': file_type,
-                        'size': os.path.getsize(file_path) if os.path.exists(file_path) else 0
-                    }
-                    
-                    # 文件类型统计（用于显示分布）
-                    stats['file_type_stats'][file_type] += lines
-                    
-                    # 文件夹统计 - 累加到所有父级文件夹
-                    folder = os.path.dirname(relative_path) or '.'
-                    
-                    # 创建所有父级文件夹的路径列表
-                    folder_paths = []
-                    current_path = folder
-                    while current_path and current_path != '.':
-                        folder_paths.append(current_path)
-                        parent = os.path.dirname(current_path)
-                        if parent == current_path:  # 到达根目录
-                            break
-                        current_path = parent
-                    
-                    # 添加根目录
-                    folder_paths.append('.')
-                    
-                    # 将文件统计累加到所有父级文件夹
-                    for folder_path in folder_paths:
-                        if folder_path not in stats['folder_stats']:
-                            stats['folder_stats'][folder_path] = {'lines': 0, 'files': 0}
-                        stats['folder_stats'][folder_path]['lines'] += lines
-                        stats['folder_stats'][folder_path]['files'] += 1
-    
-    # 计算百分比
+    # 使用文件扩展名分类显示
+    file_type = ext if ext else '无扩展名'
+    
+    # 记录文件统计
+    stats['file_stats'][relative_path] = {
+        'lines': lines,
+        'file_type': file_type,
+        'size': size
+    }
+    
+    # 文件类型统计（用于显示分布）
+    stats['file_type_stats'][file_type] += lines
+    
+    # 文件夹统计 - 累加到所有父级文件夹
+    folder = os.path.dirname(relative_path) or '.'
+    
+    # 创建所有父级文件夹的路径列表
+    folder_paths = []
+    current_path = folder
+    while current_path and current_path != '.':
+        folder_paths.append(current_path)
+        parent = os.path.dirname(current_path)
+        if parent == current_path:  # 到达根目录
+            break
+        current_path = parent
+    
+    # 添加根目录
+    folder_paths.append('.')
+    
+    # 将文件统计累加到所有父级文件夹
+    for folder_path in folder_paths:
+        if folder_path not in stats['folder_stats']:
+            stats['folder_stats'][folder_path] = {'lines': 0, 'files': 0}
+        stats['folder_stats'][folder_path]['lines'] += lines
+        stats['folder_stats'][folder_path]['files'] += 1
+
+def _finalize_stats(stats):
+    """计算文件和文件夹的行数占比"""
     if stats['total_lines'] > 0:
         for file_path, file_info in stats['file_stats'].items():
             file_info['percentage'] = (file_info['lines'] / stats['total_lines']) * 100
@@ -281,6 +609,106 @@ def analyze_repository(repo_path):
     
     return stats
 
+def _tokei_report_lines(report_stats):
+    """tokei单个文件的总行数，包括嵌入的其他语言代码块（如Markdown中的代码）"""
+    lines = report_stats['code'] + report_stats['comments'] + report_stats['blanks']
+    for blob in report_stats.get('blobs', {}).values():
+        lines += _tokei_report_lines(blob)
+    return lines
+
+def analyze_repository_with_tokei(repo_path):
+    """使用tokei分析仓库，tokei执行失败时返回None"""
+    cmd = [TOKEI_PATH, '--output', 'json']
+    for name in SKIP_DIRS:
+        cmd += ['--exclude', name]
+    cmd.append(repo_path)
+    
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        if result.returncode != 0:
+            print(f"Tokei failed: {result.stderr.strip()}")
+            return None
+        languages = json.loads(result.stdout)
+    except Exception as e:
+        print(f"Tokei exception: {e}")
+        return None
+    
+    stats = _new_stats()
+    for language, info in languages.items():
+        if language == 'Total':
+            continue
+        
+        for report in info.get('reports', []):
+            lines = _tokei_report_lines(report['stats'])
+            if lines <= 0:  # 只统计非空文件
+                continue
+            
+            file_path = os.path.join(repo_path, report['name'])
+            relative_path = os.path.relpath(file_path, repo_path).replace('\\', '/')
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                size = 0
+            _, ext = os.path.splitext(file_path)
+            _add_file_stats(stats, relative_path, lines, size, ext)
+    
+    return _finalize_stats(stats)
+
+def analyze_repository(repo_path):
+    """分析仓库结构和代码行数，配置了tokei时优先使用tokei"""
+    if TOKEI_PATH:
+        stats = analyze_repository_with_tokei(repo_path)
+        if stats is not None:
+            return stats
+    
+    stats = _new_stats()
+    
+    # 先遍历目录收集待分析的文件，文件大小直接取自DirEntry缓存的stat结果
+    candidates = []
+    for entry, relative_path in iter_files(repo_path):
+        try:
+            st = entry.stat()
+        except OSError:  # 文件在遍历期间被删除等情况，跳过该文件
+            continue
+        # Windows上DirEntry.stat()不提供st_dev/st_ino，因此缓存键同时包含路径
+        cache_key = (entry.path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        # 扩展名每个文件只计算一次，后续检测和分类统计都复用
+        _, ext = os.path.splitext(entry.name)
+        candidates.append((entry.path, relative_path, st.st_size, ext, cache_key))
+    
+    # 文件内容未变化时直接复用上次的检测结果，只把未命中的文件交给进程池
+    results = {}
+    misses = []
+    for candidate in candidates:
+        cached = _get_cached_classification(candidate[4])
+        if cached is None:
+            misses.append(candidate)
+        else:
+            results[candidate[1]] = cached
+    
+    if misses:
+        # 多进程并行完成文本检测和行数统计，结果在主进程中汇总
+        executor = get_analyze_executor()
+        try:
+            classified = executor.map(classify_and_count,
+                                      [m[0] for m in misses],
+                                      [m[2] for m in misses],
+                                      [m[3].lower() for m in misses],
+                                      chunksize=64)
+            for (_, relative_path, _, _, cache_key), result in zip(misses, classified):
+                _put_cached_classification(cache_key, result)
+                results[relative_path] = result
+        except BrokenProcessPool:
+            reset_analyze_executor()
+            raise
+    
+    for file_path, relative_path, size, ext, _ in candidates:
+        is_text, lines = results[relative_path]
+        if is_text and lines > 0:  # 只统计非空的文本文件
+            _add_file_stats(stats, relative_path, lines, size, ext)
+    
+    return _finalize_stats(stats)
+
 @app.route('/health')
 def health_check():
     """健康检查接口"""
@@ -293,9 +721,58 @@ def test_page():
     with open(os.path.join(os.path.dirname(__file__), 'test.html'), 'r', encoding='utf-8') as f:
         return f.read()
 
+def get_stats(owner, repo, repo_url):
+    """
+    获取仓库统计结果，返回 (统计结果, 是否来自缓存, 错误信息)
+    远程仓库最新提交已统计过时直接使用磁盘缓存，否则重新克隆并统计
+    """
+    commit_sha = get_remote_head(repo_url)
+    if commit_sha:
+        stats = load_cached_stats(owner, repo, commit_sha)
+        if stats is not None:
+            return stats, True, None
+    
+    # 清理长时间未使用的仓库
+    clean_old_repos()
+    ensure_repos_dir()
+    
+    # 每个仓库使用固定的目录，再次统计时只需增量更新
+    repo_dir = os.path.join(REPOS_DIR, _safe_name(owner, repo))
+    
+    with repo_lock(repo_dir):
+        # 等待锁期间其他请求可能已经统计过同一提交
+        if commit_sha:
+            stats = load_cached_stats(owner, repo, commit_sha)
+            if stats is not None:
+                return stats, True, None
+        
+        # 克隆或更新仓库
+        success, message = update_repository(repo_url, repo_dir)
+        if not success:
+            return None, False, message
+        
+        # 记录最近使用时间，供 clean_old_repos 判断
+        os.utime(repo_dir)
+        
+        # 远程仓库可能在 ls-remote 之后又有新提交，缓存以实际分析的提交为准
+        analyzed_sha = get_local_head(repo_dir)
+        if analyzed_sha and analyzed_sha != commit_sha:
+            stats = load_cached_stats(owner, repo, analyzed_sha)
+            if stats is not None:
+                return stats, True, None
+        
+        # 分析代码
+        stats = analyze_repository(repo_dir)
+        
+        # 在锁内写入缓存，之后获得锁的请求才能命中
+        if analyzed_sha:
+            save_cached_stats(owner, repo, analyzed_sha, stats)
+    
+    return stats, False, None
+
 @app.route('/api/stats', methods=['POST'])
 def get_repository_stats():
-    """获取仓库统计信息 - 每次都重新统计"""
+    """获取仓库统计信息 - 仓库有新提交时重新统计"""
     data = request.get_json()
     if not data or 'repoUrl' not in data:
         return jsonify({'error': '缺少仓库URL'}), 400
@@ -308,34 +785,16 @@ def get_repository_stats():
         return jsonify({'error': '缺少仓库信息'}), 400
     
     try:
-        # 每次都清理所有旧仓库
-        clean_all_repos()
-        ensure_repos_dir()
-        
-        # 创建临时目录
-        repo_dir = os.path.join(REPOS_DIR, f"{owner}_{repo}_{int(time.time())}")
-        
-        # 克隆仓库
-        success, message = clone_repository(repo_url, repo_dir)
-        if not success:
-            return jsonify({'error': f'克隆失败: {message}'}), 500
-        
-        # 分析代码
-        stats = analyze_repository(repo_dir)
-        
-        # 立即清理临时文件
-        if os.path.exists(repo_dir):
-            try:
-                shutil.rmtree(repo_dir)
-            except:
-                pass
+        stats, cached, error = get_stats(owner, repo, repo_url)
+        if error:
+            return jsonify({'error': f'克隆失败: {error}'}), 500
         
         # 返回统计结果
         return jsonify({
             'totalLines': stats['total_lines'],
             'totalFiles': stats['total_files'],
             'processing': False,
-            'cached': False
+            'cached': cached
         })
         
     except Exception as e:
@@ -343,12 +802,23 @@ def get_repository_stats():
 
 @app.route('/api/stats/status/<owner>/<repo>')
 def get_stats_status(owner, repo):
-    """检查统计状态 - 不再使用缓存"""
-    return jsonify({'ready': False, 'message': '请直接调用 /api/stats 接口获取最新统计'})
+    """检查统计状态 - 仓库最新提交已有缓存时直接返回结果"""
+    repo_url = f"https://github.com/{owner}/{repo}.git"
+    commit_sha = get_remote_head(repo_url)
+    stats = load_cached_stats(owner, repo, commit_sha) if commit_sha else None
+    if stats is None:
+        return jsonify({'ready': False, 'message': '请直接调用 /api/stats 接口获取最新统计'})
+    
+    return jsonify({
+        'ready': True,
+        'totalLines': stats['total_lines'],
+        'totalFiles': stats['total_files'],
+        'cached': True
+    })
 
 @app.route('/stats')
 def stats_page():
-    """统计详情页面 - 实时重新统计"""
+    """统计详情页面 - 仓库有新提交时重新统计"""
     owner = request.args.get('owner')
     repo = request.args.get('repo')
     repo_url = request.args.get('repo_url')
@@ -360,28 +830,10 @@ def stats_page():
         repo_url = f"https://github.com/{owner}/{repo}.git"
     
     try:
-        # 每次都重新统计
-        clean_all_repos()
-        ensure_repos_dir()
-        
-        # 创建临时目录
-        repo_dir = os.path.join(REPOS_DIR, f"{owner}_{repo}_{int(time.time())}")
-        
-        # 克隆仓库
-        success, message = clone_repository(repo_url, repo_dir)
-        if not success:
+        stats, _, error = get_stats(owner, repo, repo_url)
+        if error:
             return render_template_string(ERROR_TEMPLATE, 
-                                        owner=owner, repo=repo, error=message)
-        
-        # 分析代码
-        stats = analyze_repository(repo_dir)
-        
-        # 立即清理临时文件
-        if os.path.exists(repo_dir):
-            try:
-                shutil.rmtree(repo_dir)
-            except:
-                pass
+                                        owner=owner, repo=repo, error=error)
         
         # 将stats转换为Base64编码的JSON，避免转义问题
         import json
@@ -611,31 +1063,13 @@ STATS_TEMPLATE = '''
             }
             
             // 处理文件夹数据 - 创建层级结构
-            const allFolders = new Set();
-            
-            // 先收集所有可能的文件夹路径
-            for (const [filePath, fileInfo] of Object.entries(stats.file_stats || {})) {
-                const pathParts = filePath.split('/');
-                if (pathParts.length > 1) {
-                    // 为文件路径创建所有父级目录
-                    for (let i = 1; i < pathParts.length; i++) {
-                        const folderPath = pathParts.slice(0, i).join('/');
-                        allFolders.add(folderPath);
-                    }
-                }
-            }
-            
-            // 处理已有的文件夹统计数据
+            // 服务端统计时已将每个文件累加到所有父级文件夹，folder_stats 包含了全部文件夹
             for (const [folderPath, folderInfo] of Object.entries(stats.folder_stats || {})) {
                 if (folderPath === '.') {
-                    // 处理根目录的文件
+                    // 根目录本身不作为条目显示
                     continue;
                 }
-                allFolders.add(folderPath);
-            }
-            
-            // 为每个文件夹创建条目
-            for (const folderPath of allFolders) {
+                
                 const pathParts = folderPath.split('/');
                 const folderName = pathParts[pathParts.length - 1];
                 const parentPath = pathParts.length > 1 ? pathParts.slice(0, -1).join('/') : '';
@@ -644,9 +1078,6 @@ STATS_TEMPLATE = '''
                     folderData[parentPath] = [];
                 }
                 
-                // 使用统计数据或默认值
-                const folderInfo = stats.folder_stats[folderPath] || { lines: 0, files: 0, percentage: 0 };
-                
                 folderData[parentPath].push({
                     name: folderName,
                     path: folderPath,